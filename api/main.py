@@ -1,19 +1,24 @@
-import os, sys
-from fastapi import FastAPI, HTTPException
+import os, sys, asyncio, re, time, hashlib, fcntl
+import aiofiles
+import msgspec
+from uuid import uuid4
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from pydantic import BaseModel
-from src.indexing import build_basic_fixed_size_index, build_automerging_index, build_sentence_window_index, delete_document_collections
+from src.indexing import build_basic_fixed_size_index, build_automerging_index, build_sentence_window_index, delete_document_collections, normalize_index_name
 from src.retrieval import basic_query_from_documents, get_all_index_names
-from src.utils import get_chat_file_name, get_all_files_from_directory, print_data_sources, get_timestamp
-from typing import Union, List, Optional
+from src.models import warm_up_models
+from src.ttl_cache import TTLCache
+from src.utils import get_chat_file_name, get_all_files_from_directory, find_missing_files, collect_context_and_sources, get_timestamp
+from typing import Annotated, Union, List, Optional
 # 将项目根目录添加到 sys.path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
-from helper import get_api_key, get_base_url, get_chat_record_dir
+from helper import get_api_key, get_base_url, get_chat_record_dir, get_job_state_dir
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # 添加 CORS 中间件
 app.add_middleware(
@@ -28,6 +33,7 @@ api_key = get_api_key()
 base_url= get_base_url()
 model_name = "deepseek-r1-huoshan"
 chat_record_dir= get_chat_record_dir()
+job_state_dir = get_job_state_dir()
 
 model = ChatOpenAI(
     base_url=base_url,
@@ -37,17 +43,48 @@ model = ChatOpenAI(
     streaming=True
 )
 
-class QueryRequest(BaseModel):
+# 短时间内相同问题的检索结果缓存，带引号的精确查询不走缓存
+retrieval_cache = TTLCache(max_items=2048, ttl_sec=30)
+quoted_phrase_pattern = re.compile(r'"[^"]+"|“[^”]+”')
+
+@app.on_event("startup")
+async def warm_up():
+    # 启动时预热模型，第一个请求不再承担初始化耗时
+    await asyncio.to_thread(warm_up_models)
+
+def msgspec_body(struct_type):
+    """用 msgspec 解码并校验请求体，替代 pydantic 模型的解析开销"""
+    decoder = msgspec.json.Decoder(struct_type)
+
+    async def decode_body(request: Request):
+        try:
+            return decoder.decode(await request.body())
+        except (msgspec.ValidationError, msgspec.DecodeError) as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+    return decode_body
+
+def msgspec_openapi(struct_type):
+    """由 msgspec 结构生成接口的 requestBody 描述，Depends 解码的请求体不会自动出现在 /openapi.json 中"""
+    (schema,), components = msgspec.json.schema_components([struct_type], ref_template="#/components/schemas/{name}")
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": components.get(struct_type.__name__, schema)}},
+        }
+    }
+
+class QueryRequest(msgspec.Struct):
     question: str
     index_names: List[str]
-    similarity_top_k: int = 12
+    similarity_top_k: Annotated[int, msgspec.Meta(ge=1)] = 12
     chat_record_dir: str = chat_record_dir
 
 class ChatRequest(BaseModel):
     question: str
     chat_record_dir: str = chat_record_dir
 
-class BuildIndexRequest(BaseModel):
+class BuildIndexRequest(msgspec.Struct):
     input_path: Union[List[str], str]  # 支持文件路径列表或目录路径
     index_name: str
     index_type: str = "basic"  # "basic", "automerging", or "sentence_window"
@@ -55,6 +92,94 @@ class BuildIndexRequest(BaseModel):
     chunk_size: Optional[int] = 1024
     chunk_overlap: Optional[int] = 200
     chunk_sizes: Optional[List[int]] = None
+    batch_size: int = 200  # 每个 Weaviate 批量请求包含的对象数
+    num_workers: int = 4  # 并发的批量请求数
+    consistency_level: Optional[str] = None  # "ONE", "QUORUM", or "ALL"
+
+class JobState(BaseModel):
+    job_id: str
+    index_name: str
+    status: str = "queued"  # "queued", "running", "success", or "failed"
+    message: str = ""
+    num_files: int = 0
+    nodes_embedded: int = 0
+    nodes_total: int = 0
+
+# 多个 worker 进程之间不共享内存，任务状态写入文件，任一 worker 都能按 job_id 查询
+job_id_pattern = re.compile(r'^[0-9a-f]{32}$')
+# 已结束任务的状态文件保留时长，超过后在提交新任务时清理
+job_state_ttl_sec = 24 * 3600
+
+def get_job_state_path(job_id):
+    return os.path.join(job_state_dir, f"{job_id}.json")
+
+def save_job_state(job: JobState):
+    # 先写临时文件再替换，避免查询时读到写了一半的状态
+    os.makedirs(job_state_dir, exist_ok=True)
+    job_state_path = get_job_state_path(job.job_id)
+    tmp_path = f"{job_state_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(job.model_dump_json())
+    os.replace(tmp_path, job_state_path)
+
+def load_job_state(job_id):
+    job_state_path = get_job_state_path(job_id)
+    if not job_id_pattern.match(job_id) or not os.path.exists(job_state_path):
+        return None
+    with open(job_state_path, 'r', encoding='utf-8') as f:
+        return JobState.model_validate_json(f.read())
+
+def acquire_index_lock(index_name):
+    """对索引加跨进程的非阻塞文件锁，同一索引已有构建任务在运行时返回 None
+    进程退出时操作系统会自动释放 flock，构建中途崩溃也不会留下失效的锁
+    """
+    os.makedirs(job_state_dir, exist_ok=True)
+    lock_file = open(os.path.join(job_state_dir, f"{normalize_index_name(index_name)}.lock"), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+def release_index_lock(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+def check_unfinished_job(job: JobState):
+    """构建期间一直持有索引锁，未结束的任务如果能拿到锁，说明执行它的 worker 已经退出，将其标记为失败"""
+    if job is None or job.status not in ("queued", "running"):
+        return job
+    lock_file = acquire_index_lock(job.index_name)
+    if lock_file is None:
+        return job
+    try:
+        # 拿到锁后重新读取，避免覆盖刚刚正常结束的任务状态
+        job = load_job_state(job.job_id)
+        if job is not None and job.status in ("queued", "running"):
+            job.status = "failed"
+            job.message = "Build worker exited before the job finished"
+            save_job_state(job)
+        return job
+    finally:
+        release_index_lock(lock_file)
+
+def prune_job_states():
+    """删除已结束且超过保留时长的任务状态文件"""
+    if not os.path.isdir(job_state_dir):
+        return
+    expire_time = time.time() - job_state_ttl_sec
+    for file_name in os.listdir(job_state_dir):
+        job_id, ext = os.path.splitext(file_name)
+        job_state_path = os.path.join(job_state_dir, file_name)
+        try:
+            if ext != ".json" or os.path.getmtime(job_state_path) > expire_time:
+                continue
+            job = check_unfinished_job(load_job_state(job_id))
+            if job is not None and job.status in ("success", "failed"):
+                os.remove(job_state_path)
+        except (OSError, ValueError) as e:
+            print(f"Error pruning job state {file_name}: {e}")
 
 class GetIndexNamesRequest(BaseModel):
     pass
@@ -63,8 +188,38 @@ class GetIndexNamesRequest(BaseModel):
 class DeleteIndexRequest(BaseModel):
     index_names: List[str]
 
-@app.post("/query")
-async def query_from_documents_api(request: QueryRequest):
+async def open_chat_record(chat_record_file, header):
+    """打开对话记录文件并写入开头，目录不存在或不可写时返回 None"""
+    try:
+        f = await aiofiles.open(chat_record_file, 'w', encoding='utf-8')
+    except OSError as e:
+        print(f"Error opening chat record {chat_record_file}: {e}")
+        return None
+    return await write_chat_record(f, header)
+
+async def write_chat_record(f, text):
+    """追加写入对话记录，写入失败时关闭文件并返回 None，后续内容不再记录"""
+    if f is None:
+        return None
+    try:
+        await f.write(text)
+        return f
+    except OSError as e:
+        print(f"Error writing chat record: {e}")
+        await close_chat_record(f)
+        return None
+
+async def close_chat_record(f):
+    if f is None:
+        return
+    try:
+        await f.close()
+    except OSError as e:
+        print(f"Error closing chat record: {e}")
+
+
+@app.post("/query", openapi_extra=msgspec_openapi(QueryRequest))
+async def query_from_documents_api(request: QueryRequest = Depends(msgspec_body(QueryRequest))):
     try:
         file_name = f"{get_timestamp()}RAG-{get_chat_file_name(request.question)}"
         chat_record_file = os.path.join(
@@ -73,33 +228,45 @@ async def query_from_documents_api(request: QueryRequest):
         )
         
         async def generate():
-            # Call the basic query function
-            source_nodes = basic_query_from_documents(
-                question=request.question,
-                index_names=request.index_names,
-                similarity_top_k=request.similarity_top_k
+            cache_key = (
+                hashlib.blake2b(request.question.encode("utf-8")).digest(),
+                tuple(sorted(request.index_names)),
+                request.similarity_top_k
             )
+            use_cache = not quoted_phrase_pattern.search(request.question)
+            source_nodes = retrieval_cache.get(cache_key) if use_cache else None
 
-            context = "\n".join([n.text for n in source_nodes])
-            
-            print_data = print_data_sources(source_nodes)
-            print(f"Number of source nodes: {len(source_nodes)}")
+            if source_nodes is None:
+                # 检索和向量计算会阻塞，放到线程中执行，避免拖慢其他流式响应
+                source_nodes = await asyncio.to_thread(
+                    basic_query_from_documents,
+                    question=request.question,
+                    index_names=request.index_names,
+                    similarity_top_k=request.similarity_top_k
+                )
+                if use_cache:
+                    retrieval_cache.set(cache_key, source_nodes)
+
+            # 一次遍历同时得到上下文和数据来源记录，不再分别遍历 source_nodes
+            context, source_datas, len_bytes = await asyncio.to_thread(collect_context_and_sources, source_nodes)
+            print(f"Number of source nodes: {len(source_nodes)}, context bytes: {len_bytes}")
 
             # 流式返回 LLM 的响应
-            full_response = ""
             prompt_template = ChatPromptTemplate([
                 ("user", "**response with \"\<think\>\n\" at the beginning of every output.**\nUse the following pieces of context to answer the question at the end.\n{context}\nQuestion: {question}")
             ])
-            prompt = prompt_template.invoke({"context": context, "question": request.question})
-            response = model.stream(prompt)
-            
-            for chunk in response:
-                yield chunk.content
-                full_response += chunk.content
+            # format_messages 直接生成消息列表，跳过 invoke 的输入校验
+            prompt = prompt_template.format_messages(context=context, question=request.question)
             
-            # 最后写入文件
-            with open(chat_record_file, 'w', encoding='utf-8') as f:
-                f.write(f"{file_name}\n\n[question]:\n\n{request.question}\n\n[answer]:\n\n{full_response}\n\n[source_datas]:\n\n{print_data}")
+            # 边生成边写入文件，不在内存中拼接完整回答；记录文件写不了时照常返回回答
+            f = await open_chat_record(chat_record_file, f"{file_name}\n\n[question]:\n\n{request.question}\n\n[answer]:\n\n")
+            try:
+                async for chunk in model.astream(prompt):
+                    yield chunk.content
+                    f = await write_chat_record(f, chunk.content)
+                f = await write_chat_record(f, f"\n\n[source_datas]:\n\n{source_datas}")
+            finally:
+                await close_chat_record(f)
 
         return StreamingResponse(generate(), media_type="text/plain")
         
@@ -117,20 +284,19 @@ async def chat_with_llm_api(request: ChatRequest):
         )
 
         async def generate():
-            full_response = ""
             prompt_template = ChatPromptTemplate([
                 ("user", "**response with \"\<think\>\n\" at the beginning of every output**\nQuestion: {question}")
             ])
             prompt = prompt_template.invoke({"question": request.question})
-            response = model.stream(prompt)
             
-            for chunk in response:
-                yield chunk.content
-                full_response += chunk.content
-            
-            # 最后写入文件
-            with open(chat_record_file, 'w', encoding='utf-8') as f:
-                f.write(f"{file_name}\n\n[question]:\n\n{request.question}\n\n[answer]:\n\n{full_response}")
+            # 边生成边写入文件，不在内存中拼接完整回答；记录文件写不了时照常返回回答
+            f = await open_chat_record(chat_record_file, f"{file_name}\n\n[question]:\n\n{request.question}\n\n[answer]:\n\n")
+            try:
+                async for chunk in model.astream(prompt):
+                    yield chunk.content
+                    f = await write_chat_record(f, chunk.content)
+            finally:
+                await close_chat_record(f)
 
         return StreamingResponse(generate(), media_type="text/plain")
         
@@ -138,59 +304,129 @@ async def chat_with_llm_api(request: ChatRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/build-index")
-async def build_index_api(request: BuildIndexRequest):
+def run_build_index(request: BuildIndexRequest, input_files, progress_callback=None):
+    build_kwargs = {
+        "batch_size": request.batch_size,
+        "num_workers": request.num_workers,
+        "consistency_level": request.consistency_level,
+        "progress_callback": progress_callback,
+    }
+
+    # 根据索引类型调用相应的构建函数
+    if request.index_type == "basic":
+        build_basic_fixed_size_index(
+            input_files=input_files,
+            index_name=request.index_name,
+            chunk_size=request.chunk_size,
+            chunk_overlap=request.chunk_overlap,
+            **build_kwargs
+        )
+    elif request.index_type == "automerging":
+        build_automerging_index(
+            input_files=input_files,
+            index_name=request.index_name,
+            chunk_sizes=request.chunk_sizes,
+            **build_kwargs
+        )
+    elif request.index_type == "sentence_window":
+        build_sentence_window_index(
+            input_files=input_files,
+            index_name=request.index_name,
+            **build_kwargs
+        )
+    else:
+        raise ValueError(f"Invalid index type: {request.index_type}")
+
+
+async def build_index_job(job: JobState, request: BuildIndexRequest, input_files, lock_file):
+    job.status = "running"
+
+    def update_progress(nodes_embedded, nodes_total):
+        # 在构建线程中调用，直接写文件
+        job.nodes_embedded = nodes_embedded
+        job.nodes_total = nodes_total
+        save_job_state(job)
+
+    try:
+        await asyncio.to_thread(save_job_state, job)
+        # 切分和向量计算都是 CPU 密集型操作，放到线程中执行，避免阻塞事件循环
+        await asyncio.to_thread(run_build_index, request, input_files, update_progress)
+        job.status = "success"
+        job.message = f"Index '{request.index_name}' built successfully"
+        # 索引内容已变化，清空本进程的检索缓存，其他 worker 的缓存由 TTL 过期
+        retrieval_cache.clear()
+    except Exception as e:
+        job.status = "failed"
+        job.message = str(e)
+    finally:
+        await asyncio.to_thread(save_job_state, job)
+        release_index_lock(lock_file)
+
+
+@app.post("/build-index", status_code=202, openapi_extra=msgspec_openapi(BuildIndexRequest))
+async def build_index_api(background_tasks: BackgroundTasks, request: BuildIndexRequest = Depends(msgspec_body(BuildIndexRequest))):
     try:
         # 处理输入路径
         if isinstance(request.input_path, str):
             # 如果是目录路径，使用 get_all_files_from_directory
-            input_files = get_all_files_from_directory(
+            input_files = await asyncio.to_thread(
+                get_all_files_from_directory,
                 request.input_path,
                 file_extension=request.file_extension
             )
         else:
-            # 如果是文件路径列表，直接使用
+            # 如果是文件路径列表，有不存在的文件时直接报错，
+            # 否则增量构建会把写错的路径当作已删除的文件，删掉索引中对应的对象
+            missing_files = await asyncio.to_thread(find_missing_files, request.input_path)
+            if missing_files:
+                raise ValueError(f"Input files not found: {missing_files}")
             input_files = request.input_path
 
         if not input_files:
             raise ValueError("No valid input files found")
 
-        # 根据索引类型调用相应的构建函数
-        if request.index_type == "basic":
-            build_basic_fixed_size_index(
-                input_files=input_files,
-                index_name=request.index_name,
-                chunk_size=request.chunk_size,
-                chunk_overlap=request.chunk_overlap
-            )
-        elif request.index_type == "automerging":
-            build_automerging_index(
-                input_files=input_files,
+        if request.index_type not in ("basic", "automerging", "sentence_window"):
+            raise ValueError(f"Invalid index type: {request.index_type}")
+
+        # 同一索引的构建任务会竞争集合的删除重建、旧对象清理和清单，同一时间只允许一个
+        lock_file = await asyncio.to_thread(acquire_index_lock, request.index_name)
+        if lock_file is None:
+            raise HTTPException(status_code=409, detail=f"Index '{request.index_name}' is already being built")
+
+        try:
+            await asyncio.to_thread(prune_job_states)
+            job = JobState(
+                job_id=uuid4().hex,
                 index_name=request.index_name,
-                chunk_sizes=request.chunk_sizes
-            )
-        elif request.index_type == "sentence_window":
-            build_sentence_window_index(
-                input_files=input_files,
-                index_name=request.index_name
+                num_files=len(input_files)
             )
-        else:
-            raise ValueError(f"Invalid index type: {request.index_type}")
-        
-        return {
-            "status": "success",
-            "message": f"Index '{request.index_name}' built successfully",
-            "num_files": len(input_files)
-        }
+            await asyncio.to_thread(save_job_state, job)
+            background_tasks.add_task(build_index_job, job, request, input_files, lock_file)
+        except Exception:
+            release_index_lock(lock_file)
+            raise
+
+        return job
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/build-index/{job_id}")
+async def get_build_index_job_api(job_id: str):
+    job = await asyncio.to_thread(load_job_state, job_id)
+    job = await asyncio.to_thread(check_unfinished_job, job)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return job
+
+
 @app.post("/get-index-names")
 async def get_index_names_api(request: GetIndexNamesRequest):
     try:
-        index_names = get_all_index_names()
+        index_names = await asyncio.to_thread(get_all_index_names)
         return {
             "status": "success",
             "index_names": index_names
@@ -203,7 +439,8 @@ async def get_index_names_api(request: GetIndexNamesRequest):
 async def delete_index_api(request: DeleteIndexRequest):
     try:
         # 调用删除函数
-        delete_document_collections(request.index_names)
+        await asyncio.to_thread(delete_document_collections, request.index_names)
+        retrieval_cache.clear()
         
         return {
             "status": "success",
@@ -213,7 +450,3 @@ async def delete_index_api(request: DeleteIndexRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
@@ -0,0 +1,25 @@
+import os, sys
+import uvicorn
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helper import get_api_workers
+
+
+def serve():
+    # 启动进程只负责拉起 worker，不导入 api.main，模型只在各个 worker 中加载一份。
+    # 多进程 worker 需要以导入字符串的形式传入应用，需在项目根目录执行 python -m api.serve；
+    # 每个 worker 都会加载一份 bge-m3，常驻内存随 worker 数线性增长，内存紧张时用 API_WORKERS 调小；
+    # 首次部署先执行 python -m src.models 完成模型导出，避免多个 worker 启动时同时导出
+    uvicorn.run(
+        "api.main:app",
+        host="0.0.0.0",
+        port=8001,
+        workers=get_api_workers(),
+        loop="uvloop",
+        http="httptools",
+        log_level="warning"
+    )
+
+
+if __name__ == "__main__":
+    serve()
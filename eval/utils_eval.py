@@ -3,7 +3,7 @@ from dotenv import load_dotenv, find_dotenv
 from llama_index.core import ServiceContext, VectorStoreIndex, StorageContext, load_index_from_storage
 from llama_index.core.node_parser import HierarchicalNodeParser, SentenceWindowNodeParser, get_leaf_nodes
 from llama_index.core.query_engine import RetrieverQueryEngine
-from llama_index.core.indices.postprocessor import SentenceTransformerRerank, MetadataReplacementPostProcessor
+from llama_index.core.indices.postprocessor import MetadataReplacementPostProcessor
 from llama_index.core.retrievers import AutoMergingRetriever
 import numpy as np
 
@@ -14,6 +14,8 @@ from trulens.providers.openai import OpenAI
 from trulens.apps.llamaindex import TruLlama
 
 from helper import get_api_key
+from src.models import get_reranker
+from src.arrow_docstore import ArrowDocumentStore
 # from langchain_openai import OpenAI
 # 在执行代码前手动忽略这些警告
 import warnings
@@ -108,9 +110,7 @@ def get_sentence_window_query_engine(
 ):
     # define postprocessors
     postproc = MetadataReplacementPostProcessor(target_metadata_key="window")
-    rerank = SentenceTransformerRerank(
-        top_n=rerank_top_n, model="/Users/Daglas/dalong.modelsets/bge-reranker-v2-m3"
-    )
+    rerank = get_reranker(top_n=rerank_top_n)
 
     sentence_window_engine = sentence_index.as_query_engine(
         similarity_top_k=similarity_top_k, node_postprocessors=[postproc, rerank]
@@ -134,7 +134,7 @@ def build_automerging_index(
         llm=llm,
         embed_model=embed_model,
     )
-    storage_context = StorageContext.from_defaults()
+    storage_context = StorageContext.from_defaults(docstore=ArrowDocumentStore())
     storage_context.docstore.add_documents(nodes)
 
     if not os.path.exists(save_dir):
@@ -143,8 +143,12 @@ def build_automerging_index(
         )
         automerging_index.storage_context.persist(persist_dir=save_dir)
     else:
+        # 文档存储按列读取并 mmap 正文，get_document 时才还原单个节点
         automerging_index = load_index_from_storage(
-            StorageContext.from_defaults(persist_dir=save_dir),
+            StorageContext.from_defaults(
+                docstore=ArrowDocumentStore.from_persist_dir(save_dir),
+                persist_dir=save_dir,
+            ),
             service_context=merging_context,
         )
     return automerging_index
@@ -159,9 +163,7 @@ def get_automerging_query_engine(
     retriever = AutoMergingRetriever(
         base_retriever, automerging_index.storage_context, verbose=True
     )
-    rerank = SentenceTransformerRerank(
-        top_n=rerank_top_n, model="/Users/Daglas/dalong.modelsets/bge-reranker-v2-m3"
-    )
+    rerank = get_reranker(top_n=rerank_top_n)
     auto_merging_engine = RetrieverQueryEngine.from_args(
         retriever, node_postprocessors=[rerank]
     )
@@ -246,7 +246,20 @@ function initEventListeners() {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
 
-            const result = await response.json();
+            // 索引在后台构建，轮询任务状态直到完成
+            let result = await response.json();
+            while (result.status === 'queued' || result.status === 'running') {
+                if (result.nodes_total > 0) {
+                    this.textContent = `添加中 ${result.nodes_embedded}/${result.nodes_total}`;
+                }
+                await new Promise(resolve => setTimeout(resolve, 2000));
+                const statusResponse = await fetch(`http://localhost:8001/build-index/${result.job_id}`);
+                if (!statusResponse.ok) {
+                    throw new Error(`HTTP error! status: ${statusResponse.status}`);
+                }
+                result = await statusResponse.json();
+            }
+
             if (result.status === 'success') {
                 alert('索引添加成功！');
                 selectedFiles = [];
@@ -254,7 +267,7 @@ function initEventListeners() {
                 await loadIndexNames();
                 await loadDeleteIndexList();
             } else {
-                alert('索引添加失败！');
+                alert(`索引添加失败！${result.message || ''}`);
             }
         } catch (error) {
             console.error('Error adding index:', error);
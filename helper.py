@@ -51,4 +51,34 @@ def get_chat_record_dir():
     # Get the path from environment variable, return default path if empty or not set
     default_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "easy-rag/chatrecord/")
     chat_record_dir = os.getenv("CHAT_RECORD_DIR")
-    return default_path if not chat_record_dir else chat_record_dir
\ No newline at end of file
+    return default_path if not chat_record_dir else chat_record_dir
+
+def get_embed_cache_path():
+    load_env()
+    # Get the path from environment variable, return default path if empty or not set
+    default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "embed_cache.db")
+    embed_cache_path = os.getenv("EMBED_CACHE_PATH")
+    return default_path if not embed_cache_path else embed_cache_path
+
+
+def get_index_manifest_dir():
+    load_env()
+    # Get the path from environment variable, return default path if empty or not set
+    default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index_manifests")
+    index_manifest_dir = os.getenv("INDEX_MANIFEST_DIR")
+    return default_path if not index_manifest_dir else index_manifest_dir
+
+def get_job_state_dir():
+    load_env()
+    # Get the path from environment variable, return default path if empty or not set
+    default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "job_states")
+    job_state_dir = os.getenv("JOB_STATE_DIR")
+    return default_path if not job_state_dir else job_state_dir
+
+
+def get_api_workers():
+    load_env()
+    # Each worker process loads its own copy of the embedding model, so memory grows with the worker count
+    default_workers = max(2, (os.cpu_count() or 2) // 2)
+    api_workers = os.getenv("API_WORKERS")
+    return default_workers if not api_workers else int(api_workers)
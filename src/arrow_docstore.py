@@ -0,0 +1,176 @@
+import json, mmap, os
+import pyarrow as pa
+from llama_index.core.constants import DATA_KEY
+from llama_index.core.schema import NodeRelationship
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.kvstore import SimpleKVStore
+from llama_index.core.storage.kvstore.types import DEFAULT_COLLECTION
+
+docstore_table_file = "docstore.arrow"
+docstore_text_file = "text.bin"
+docstore_meta_file = "docstore_meta.json"
+
+docstore_schema = pa.schema([
+    ("id", pa.string()),
+    ("parent_id", pa.string()),
+    ("text_offset", pa.int64()),
+    ("text_len", pa.int64()),
+    # 去掉正文后的节点 JSON，metadata 和 relationships 仍需提供给 AutoMergingRetriever
+    ("node", pa.string()),
+])
+
+
+class ArrowKVStore(SimpleKVStore):
+    """节点集合按需从 Arrow 列和 mmap 正文读取的 KV 存储
+
+    其余集合（ref_doc_info、metadata）和新写入的节点仍保存在内存字典中，
+    与 SimpleKVStore 的行为一致。
+    """
+
+    def __init__(self, data=None, lazy_collection=None, table=None, text_blob=None):
+        super().__init__(data)
+        self._lazy_collection = lazy_collection
+        self._table = table
+        self._text_blob = text_blob
+        self._rows = {}
+        if table is not None:
+            self._rows = {node_id: row for row, node_id in enumerate(table.column("id").to_pylist())}
+
+    def _load_row(self, row):
+        """按行号还原 doc_to_json 格式的节点字典"""
+        val = json.loads(self._table.column("node")[row].as_py())
+        offset = self._table.column("text_offset")[row].as_py()
+        if offset is not None:
+            length = self._table.column("text_len")[row].as_py()
+            val[DATA_KEY]["text"] = self._text_blob[offset:offset + length].decode("utf-8")
+        return val
+
+    def _materialize(self):
+        """将尚未读取的节点全部载入内存字典，供需要遍历整个集合的操作使用"""
+        if not self._rows:
+            return
+        collection_data = self._data.setdefault(self._lazy_collection, {})
+        for node_id, row in self._rows.items():
+            collection_data.setdefault(node_id, self._load_row(row))
+        self._rows = {}
+
+    def put(self, key, val, collection=DEFAULT_COLLECTION):
+        super().put(key, val, collection)
+        if collection == self._lazy_collection:
+            self._rows.pop(key, None)
+
+    def get(self, key, collection=DEFAULT_COLLECTION):
+        val = super().get(key, collection)
+        if val is None and collection == self._lazy_collection and key in self._rows:
+            return self._load_row(self._rows[key])
+        return val
+
+    def get_all(self, collection=DEFAULT_COLLECTION):
+        if collection == self._lazy_collection:
+            self._materialize()
+        return super().get_all(collection)
+
+    def delete(self, key, collection=DEFAULT_COLLECTION):
+        if collection == self._lazy_collection and self._rows.pop(key, None) is not None:
+            self._data.get(collection, {}).pop(key, None)
+            return True
+        return super().delete(key, collection)
+
+    def to_dict(self):
+        self._materialize()
+        return super().to_dict()
+
+
+class ArrowDocumentStore(SimpleDocumentStore):
+    """以列式 Arrow IPC 文件加内存映射正文持久化的文档存储
+
+    持久化目录下包含：
+        docstore.arrow: id、parent_id、text_offset、text_len、node 五列
+        text.bin: 所有节点正文按 UTF-8 依次拼接
+        docstore_meta.json: ref_doc_info 和 metadata 集合
+    加载时只读取列数据并 mmap 正文文件，get_document 按偏移切片还原单个节点。
+    """
+
+    def __init__(self, simple_kvstore=None, namespace=None, **kwargs):
+        super().__init__(simple_kvstore=simple_kvstore or ArrowKVStore(), namespace=namespace, **kwargs)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir, namespace=None, fs=None):
+        """从持久化目录加载文档存储，目录中只有旧版 docstore.json 时按 JSON 格式读取"""
+        table_path = os.path.join(persist_dir, docstore_table_file)
+        if not os.path.exists(table_path):
+            return super().from_persist_dir(persist_dir, namespace=namespace, fs=fs)
+
+        with pa.memory_map(table_path, "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+
+        text_blob = b""
+        text_path = os.path.join(persist_dir, docstore_text_file)
+        if os.path.getsize(text_path) > 0:
+            with open(text_path, "rb") as f:
+                text_blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with open(os.path.join(persist_dir, docstore_meta_file), "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        docstore = cls(namespace=namespace)
+        docstore._kvstore = ArrowKVStore(
+            data=data,
+            lazy_collection=docstore._node_collection,
+            table=table,
+            text_blob=text_blob,
+        )
+        return docstore
+
+    def persist(self, persist_path, fs=None):
+        """写入 persist_path 所在目录；StorageContext.persist 传入的是 docstore.json 路径
+
+        先把节点全部读入内存，再写入临时文件并逐个替换，
+        写回自身的加载目录时不会截断仍被 mmap 引用的 text.bin。
+        """
+        persist_dir = os.path.dirname(persist_path)
+        os.makedirs(persist_dir, exist_ok=True)
+
+        nodes = self._kvstore.get_all(collection=self._node_collection)
+        meta = {
+            collection: self._kvstore.get_all(collection=collection)
+            for collection in (self._ref_doc_collection, self._metadata_collection)
+        }
+
+        columns = {name: [] for name in docstore_schema.names}
+        offset = 0
+        paths = {
+            file_name: os.path.join(persist_dir, file_name)
+            for file_name in (docstore_text_file, docstore_table_file, docstore_meta_file)
+        }
+        with open(f"{paths[docstore_text_file]}.tmp", "wb") as text_file:
+            for node_id, val in nodes.items():
+                data = dict(val[DATA_KEY])
+                text = data.pop("text", None)
+                parent = (data.get("relationships") or {}).get(NodeRelationship.PARENT.value)
+                columns["id"].append(node_id)
+                columns["parent_id"].append(parent["node_id"] if parent else None)
+                if isinstance(text, str):
+                    encoded = text.encode("utf-8")
+                    text_file.write(encoded)
+                    columns["text_offset"].append(offset)
+                    columns["text_len"].append(len(encoded))
+                    offset += len(encoded)
+                else:
+                    # 没有 text 字段的节点类型保持原样存放在 node 列中
+                    if text is not None:
+                        data["text"] = text
+                    columns["text_offset"].append(None)
+                    columns["text_len"].append(None)
+                columns["node"].append(json.dumps({**val, DATA_KEY: data}, ensure_ascii=False))
+
+        table = pa.Table.from_pydict(columns, schema=docstore_schema)
+        with pa.OSFile(f"{paths[docstore_table_file]}.tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, docstore_schema) as writer:
+                writer.write_table(table)
+
+        with open(f"{paths[docstore_meta_file]}.tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        for path in paths.values():
+            os.replace(f"{path}.tmp", path)
@@ -0,0 +1,78 @@
+import hashlib, sqlite3
+from array import array
+
+
+def content_hash(text):
+    """计算文本的 16 字节 blake2b 摘要，用作缓存键和解析器配置的指纹"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """基于 SQLite 的持久化向量缓存，键为 (model_name, content_hash)
+
+    向量以 float32 字节串存储，重新建索引时内容未变的节点可以直接复用旧向量。
+    """
+
+    # SQLite 单条语句的参数上限较低，IN 查询需要分片
+    max_query_params = 500
+
+    def __init__(self, model_name, db_path):
+        self.model_name = model_name
+        # 流水线中由不同线程依次调用，不会并发访问同一连接
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model_name TEXT NOT NULL,
+                content_hash BLOB NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (model_name, content_hash)
+            )"""
+        )
+        self._conn.commit()
+
+    def get_many(self, hashes):
+        """批量查询向量
+        Args:
+            hashes: content_hash 列表
+        Returns:
+            dict: 命中的 content_hash -> 向量（list[float]）
+        """
+        hashes = list(set(hashes))
+        found = {}
+        for start in range(0, len(hashes), self.max_query_params):
+            chunk = hashes[start:start + self.max_query_params]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._conn.execute(
+                f"SELECT content_hash, vector FROM embeddings "
+                f"WHERE model_name = ? AND content_hash IN ({placeholders})",
+                [self.model_name, *chunk],
+            )
+            for key, blob in rows:
+                vector = array("f")
+                vector.frombytes(blob)
+                found[key] = vector.tolist()
+        return found
+
+    def set_many(self, items):
+        """批量写入向量
+        Args:
+            items: (content_hash, 向量) 二元组列表
+        """
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model_name, content_hash, dim, vector) VALUES (?, ?, ?, ?)",
+            [
+                (self.model_name, key, len(vector), array("f", vector).tobytes())
+                for key, vector in items
+            ],
+        )
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,73 @@
+import os, threading
+from collections import OrderedDict
+import torch
+from torch import nn
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+embedding_table_file = "word_embeddings.safetensors"
+embedding_table_key = "weight"
+
+
+class SparseEmbeddingLRU(nn.Module):
+    """按需从内存映射的 safetensors 文件读取词向量的 Embedding 层
+
+    一次建索引只会用到很小一部分词表，常用 token 的向量保存在 LRU 中，
+    未命中的行从 mmap 文件中读取，不再常驻完整的词向量表。
+    """
+
+    def __init__(self, table_path, max_rows, padding_idx=None, device="cpu"):
+        super().__init__()
+        self._handle = safe_open(table_path, framework="pt")
+        self._table = self._handle.get_slice(embedding_table_key)
+        self.num_embeddings, self.embedding_dim = self._table.get_shape()
+        self.padding_idx = padding_idx
+        self.max_rows = max_rows
+        self.device = device
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_row(self, token_id):
+        row = self._rows.get(token_id)
+        if row is None:
+            row = self._table[token_id:token_id + 1][0]
+            self._rows[token_id] = row
+            if len(self._rows) > self.max_rows:
+                self._rows.popitem(last=False)
+        else:
+            self._rows.move_to_end(token_id)
+        return row
+
+    def forward(self, input_ids):
+        unique_ids, inverse = torch.unique(input_ids, return_inverse=True)
+        with self._lock:
+            rows = [self._get_row(token_id) for token_id in unique_ids.tolist()]
+        return torch.stack(rows).to(self.device)[inverse]
+
+
+def enable_embedding_lru(embed_model, cache_ratio=0.1):
+    """将 HuggingFaceEmbedding 底层模型的词向量层替换为 SparseEmbeddingLRU
+    Args:
+        embed_model: resolve_embed_model 返回的本地 HuggingFaceEmbedding
+        cache_ratio: LRU 中最多保留的行数占词表大小的比例
+    """
+    embeddings = embed_model._model[0].auto_model.embeddings
+    word_embeddings = embeddings.word_embeddings
+    if isinstance(word_embeddings, SparseEmbeddingLRU):
+        return
+
+    # 首次使用时把词向量表导出到模型目录，之后直接 mmap 读取。
+    # 先写入本进程的临时文件再替换，其他进程不会读到写了一半的文件
+    table_path = os.path.join(embed_model.model_name, embedding_table_file)
+    if not os.path.exists(table_path):
+        weight = word_embeddings.weight.detach().cpu().contiguous()
+        tmp_path = f"{table_path}.{os.getpid()}.tmp"
+        save_file({embedding_table_key: weight}, tmp_path)
+        os.replace(tmp_path, table_path)
+
+    embeddings.word_embeddings = SparseEmbeddingLRU(
+        table_path,
+        max_rows=max(1, int(word_embeddings.num_embeddings * cache_ratio)),
+        padding_idx=word_embeddings.padding_idx,
+        device=word_embeddings.weight.device,
+    )
@@ -1,154 +1,322 @@
-import os, sys
+import os, sys, json, asyncio
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import weaviate
-from llama_index.core import SimpleDirectoryReader, StorageContext, ServiceContext, VectorStoreIndex, load_index_from_storage
+from weaviate.classes.config import ConsistencyLevel, Configure, DataType, Property, Tokenization
+from weaviate.classes.query import Filter
+from llama_index.core import SimpleDirectoryReader
+from llama_index.vector_stores.weaviate.utils import get_data_object
 from llama_index.core import Settings
-from llama_index.core.node_parser import SentenceSplitter, HierarchicalNodeParser, SentenceWindowNodeParser, get_leaf_nodes
-from llama_index.core.embeddings import resolve_embed_model
-from llama_index.core.indices.postprocessor import SentenceTransformerRerank, MetadataReplacementPostProcessor
-from llama_index.vector_stores.weaviate import WeaviateVectorStore
-from src.utils import get_all_files_from_directory
+from llama_index.core.schema import MetadataMode
+from llama_index.core.utils import get_tqdm_iterable
+from pathlib import Path
+from src.utils import get_all_files_from_directory, hash_files
+from src.embed_cache import EmbeddingCache, content_hash
+from src.models import embed_model_name, embed_batch_size, get_embed_model, get_sentence_splitter, get_hierarchical_node_parser, get_sentence_window_node_parser
+from helper import get_embed_cache_path, get_index_manifest_dir
 
-Settings.embed_model = resolve_embed_model("local:/Users/Daglas/dalong.modelsets/bge-m3")
+embed_cache_path = get_embed_cache_path()
+# 流水线中各阶段之间最多缓冲的批次数
+pipeline_queue_size = 2
+# 每个排序窗口包含的 embedding 批次数，窗口内的节点按文本长度排序后再分批，
+# 窗口越大 padding 越少，流水线中缓冲的节点也越多
+embed_sort_window = 8
+# 标量量化（SQ）在收集到 training_limit 个向量后训练各维度的取值范围，之后以 int8 存储向量，
+# 检索时再用原始向量对候选结果重新打分
+sq_training_limit = 4096
+index_manifest_dir = get_index_manifest_dir()
 
-def build_basic_fixed_size_index(input_files, index_name, chunk_size=1024, chunk_overlap=200):
-    try:
-        # 连接本地 Weaviate
-        client = weaviate.connect_to_local()
+# 每次构建写入对象 metadata 的构建 id，写入成功后按 file_path 删除修改过的文件中属于旧构建的对象
+build_id_key = "build_id"
 
-        # 检查集合是否存在，如果存在则删除
-        if client.collections.exists(index_name):
-            client.collections.delete(index_name)
-            print(f"Existing collection {index_name} has been deleted.")
-        
-        # 创建集合
-        documents = client.collections.create(name=index_name)
-        print("documents collection has been created.")
+Settings.embed_model = get_embed_model()
 
-        # load documents
-        documents = SimpleDirectoryReader(input_files=input_files).load_data()
-        # 设置文档分割器
-        splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        nodes = splitter.get_nodes_from_documents(documents)
-
-        vector_store = WeaviateVectorStore(
-            weaviate_client=client,
-            index_name=index_name,
-        )
+def embed_nodes_in_batches(nodes, batch_size=embed_batch_size, cache=None):
+    """按文本长度排序后分桶批量计算节点向量（smart batching），减少同一批次内的 padding
+    Args:
+        nodes: 待计算向量的节点列表，结果直接写回 node.embedding
+        batch_size: 每批送入 embedding 模型的文本数
+        cache: 可选的 EmbeddingCache，命中的节点直接复用缓存向量，只计算未命中的节点
+    """
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    hashes = [content_hash(text) for text in texts]
 
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    cached = cache.get_many(hashes) if cache is not None else {}
+    for node, key in zip(nodes, hashes):
+        if key in cached:
+            node.embedding = cached[key]
+    misses = [i for i, key in enumerate(hashes) if key not in cached]
 
-        index = VectorStoreIndex(
-            nodes,
-            storage_context=storage_context,
-            show_progress=True  #显示进度
-        )
+    order = sorted(misses, key=lambda i: len(texts[i]))
+    buckets = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
 
-        print("All vector data has been written to Weaviate.")
+    for bucket in buckets:
+        embeddings = Settings.embed_model.get_text_embedding_batch([texts[i] for i in bucket])
+        for i, embedding in zip(bucket, embeddings):
+            nodes[i].embedding = embedding
+        if cache is not None:
+            cache.set_many([(hashes[i], embedding) for i, embedding in zip(bucket, embeddings)])
 
-    except Exception as e:
-        print(f"Error occurred: {str(e)}")
-        raise
-    finally:
-        if 'client' in locals():
-            client.close()  # Ensure client is always closed
-            print("Weaviate connection closed.")
+def normalize_index_name(index_name):
+    # Weaviate 会把集合名称首字母大写，docs 建立后以 Docs 列出和删除
+    return index_name[:1].upper() + index_name[1:]
 
-# for auto-merging retriever
-def build_automerging_index(input_files, index_name, chunk_sizes=None):
-    try:
-        # 连接本地 Weaviate
-        client = weaviate.connect_to_local()
+def get_manifest_path(index_name):
+    # 按规范化后的集合名称保存清单，建立和删除时使用的名称大小写不同也能对应到同一个文件
+    return os.path.join(index_manifest_dir, f"{normalize_index_name(index_name)}.manifest.json")
 
-        # 检查集合是否存在，如果存在则删除
-        if client.collections.exists(index_name):
-            client.collections.delete(index_name)
-            print(f"Existing collection {index_name} has been deleted.")
-        
-        # 创建集合
-        documents = client.collections.create(name=index_name)
-        print("documents collection has been created.")
-
-        chunk_sizes = chunk_sizes or [2048, 512, 128]
-        # load documents
-        documents = SimpleDirectoryReader(input_files=input_files).load_data()
-        node_parser = HierarchicalNodeParser.from_defaults(chunk_sizes=chunk_sizes)
+def load_manifest(index_name):
+    """读取索引的文件清单
+    Returns:
+        dict: {"parser": 节点解析器配置的指纹, "files": 文件路径 -> 内容摘要}
+    """
+    manifest_path = get_manifest_path(index_name)
+    if not os.path.exists(manifest_path):
+        return {"parser": None, "files": {}}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
 
-        # 获取所有节点和叶子节点
-        nodes = node_parser.get_nodes_from_documents(documents)
-        # leaf_nodes = get_leaf_nodes(nodes)
+def save_manifest(index_name, manifest):
+    # 先写临时文件再替换，避免中途失败留下损坏的清单
+    os.makedirs(index_manifest_dir, exist_ok=True)
+    manifest_path = get_manifest_path(index_name)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
 
-        # 初始化 Weaviate 向量存储
-        vector_store = WeaviateVectorStore(
-            weaviate_client=client,
-            index_name=index_name,
-        )
+def delete_manifest(index_name):
+    manifest_path = get_manifest_path(index_name)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
 
-        # 创建存储上下文，并将所有节点（包括父节点）添加到 docstore 中
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+def load_documents(input_files, max_workers=16):
+    """用线程池并发读取文件
+    不使用 load_data(num_workers=...) 的进程池：spawn 出的子进程会重新导入 __main__，
+    进而在每个子进程中加载 embedding 模型，读文件本身以 I/O 为主，线程就足够
+    """
+    reader = SimpleDirectoryReader(input_files=input_files)
 
-        # 构建索引时传入叶子节点，同时启用 store_nodes_override，确保索引使用 docstore 中的完整节点信息
-        automerging_index = VectorStoreIndex(
-            nodes,
-            storage_context=storage_context,
-            store_nodes_override=True,
-            show_progress=True
+    def load_file(input_file):
+        return SimpleDirectoryReader.load_file(
+            input_file,
+            file_metadata=reader.file_metadata,
+            file_extractor=reader.file_extractor,
+            filename_as_id=reader.filename_as_id,
+            encoding=reader.encoding,
+            errors=reader.errors,
+            raise_on_error=reader.raise_on_error,
+            fs=reader.fs,
         )
 
-        print("All vector data has been written to Weaviate.")
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(reader.input_files))) as executor:
+        loaded = get_tqdm_iterable(executor.map(load_file, reader.input_files), True, "Loading files")
+        documents = [document for file_documents in loaded for document in file_documents]
+    # 与 load_data 一致，把文件路径等 metadata 排除在 embedding 和 LLM 文本之外
+    return reader._exclude_metadata(documents)
 
-    except Exception as e:
-        print(f"Error occurred: {str(e)}")
-        raise
-    finally:
-        if 'client' in locals():
-            client.close()  # Ensure client is always closed
-            print("Weaviate connection closed.")
+def delete_objects_where(collection, where):
+    """删除满足过滤条件的全部对象
+    delete_many 单次最多删除 QUERY_MAXIMUM_RESULTS 个对象，重复调用直到没有匹配的对象
+    Returns:
+        int: 删除的对象数
+    """
+    deleted = 0
+    while True:
+        result = collection.data.delete_many(where=where)
+        if result.failed:
+            raise RuntimeError(f"{result.failed} objects failed to be deleted from Weaviate.")
+        if result.matches == 0:
+            return deleted
+        if result.successful == 0:
+            raise RuntimeError(f"{result.matches} objects matched but none were deleted from Weaviate.")
+        deleted += result.successful
+
+async def stream_nodes_to_weaviate(
+    documents,
+    node_parser,
+    index_name,
+    batch,
+    build_id,
+    cache=None,
+    progress_callback=None,
+):
+    """以 切分 -> 向量计算 -> 写入 三段流水线处理文档，各段之间用有界队列衔接，
+    内存中只保留少量排序窗口的节点，不再一次性物化全部节点
+    Args:
+        documents: 待切分的文档列表
+        node_parser: 节点解析器
+        index_name: Weaviate 集合名称
+        batch: 已进入上下文的 Weaviate 批量写入对象
+        build_id: 本次构建的 id，写入每个节点的 metadata
+        cache: 可选的 EmbeddingCache
+        progress_callback: 可选回调，每写入一批调用 progress_callback(nodes_embedded, nodes_total)
+    """
+    node_queue = asyncio.Queue(maxsize=pipeline_queue_size)
+    embedded_queue = asyncio.Queue(maxsize=pipeline_queue_size)
+    counts = {"produced": 0, "embedded": 0}
 
+    def parse_document(document):
+        nodes = node_parser.get_nodes_from_documents([document])
+        for node in nodes:
+            node.metadata[build_id_key] = build_id
+            node.excluded_embed_metadata_keys = [*node.excluded_embed_metadata_keys, build_id_key]
+            node.excluded_llm_metadata_keys = [*node.excluded_llm_metadata_keys, build_id_key]
+        return nodes
 
-# the sentence window retrieval
-def build_sentence_window_index(input_files, index_name):
+    async def producer():
+        # 按排序窗口而不是单个批次送入向量计算，embed_nodes_in_batches 在窗口内按长度排序分批
+        pending = []
+        for document in documents:
+            for node in await asyncio.to_thread(parse_document, document):
+                pending.append(node)
+                if len(pending) == embed_batch_size * embed_sort_window:
+                    counts["produced"] += len(pending)
+                    await node_queue.put(pending)
+                    pending = []
+        if pending:
+            counts["produced"] += len(pending)
+            await node_queue.put(pending)
+        await node_queue.put(None)
+
+    async def embedder():
+        while (nodes := await node_queue.get()) is not None:
+            await asyncio.to_thread(embed_nodes_in_batches, nodes, cache=cache)
+            await embedded_queue.put(nodes)
+        await embedded_queue.put(None)
+
+    async def writer():
+        while (nodes := await embedded_queue.get()) is not None:
+            for node in nodes:
+                data_object = get_data_object(node=node)
+                batch.add_object(
+                    collection=index_name,
+                    properties=data_object.properties,
+                    uuid=data_object.uuid,
+                    vector=data_object.vector,
+                )
+            counts["embedded"] += len(nodes)
+            if progress_callback:
+                progress_callback(counts["embedded"], counts["produced"])
+
+    tasks = [asyncio.create_task(stage()) for stage in (producer, embedder, writer)]
+    try:
+        await asyncio.gather(*tasks)
+    except Exception:
+        # 任一阶段失败时取消其余阶段，避免阻塞在队列上
+        for task in tasks:
+            task.cancel()
+        raise
+    print(f"{counts['embedded']} new nodes have been written.")
+
+def create_document_index(
+    input_files,
+    index_name,
+    node_parser,
+    batch_size=200,
+    num_workers=4,
+    consistency_level=None,
+    progress_callback=None,
+):
+    """切分文档并将节点批量写入 Weaviate
+    Args:
+        input_files: 需要索引的文件路径列表
+        index_name: Weaviate 集合名称
+        node_parser: 用于切分文档的节点解析器
+        batch_size: 每个批量请求包含的对象数
+        num_workers: 并发的批量请求数
+        consistency_level: 写入一致性级别，"ONE"、"QUORUM" 或 "ALL"
+        progress_callback: 可选回调，向量计算进度变化时调用 progress_callback(nodes_embedded, nodes_total)
+    """
     try:
         # 连接本地 Weaviate
         client = weaviate.connect_to_local()
 
-        # 检查集合是否存在，如果存在则删除
+        # 与 SimpleDirectoryReader 写入 metadata 的 file_path 保持一致
+        input_files = [str(Path(f)) for f in input_files]
+        file_hashes = hash_files(input_files)
+        parser_signature = content_hash(json.dumps(node_parser.to_dict(), sort_keys=True, default=str)).hex()
+        manifest = load_manifest(index_name)
+        build_id = uuid4().hex
+
+        # 旧版本建立的集合没有构建 id 属性，或 file_path 按单词分词（过滤时会匹配到共享路径片段的其他文件），
+        # 解析器配置变化后所有节点都会改变，这几种情况删除后重建
         if client.collections.exists(index_name):
-            client.collections.delete(index_name)
-            print(f"Existing collection {index_name} has been deleted.")
-        
-        # 创建集合
-        documents = client.collections.create(name=index_name)
-        print("documents collection has been created.")
+            properties = {p.name: p for p in client.collections.get(index_name).config.get().properties}
+            if (
+                build_id_key not in properties
+                or "file_path" not in properties
+                or properties["file_path"].tokenization != Tokenization.FIELD
+                or manifest["parser"] != parser_signature
+            ):
+                client.collections.delete(index_name)
+                print(f"Existing collection {index_name} has been deleted.")
 
-        # load documents
-        documents = SimpleDirectoryReader(input_files=input_files).load_data()
-        # create the sentence window node parser w/ default settings
-        node_parser = SentenceWindowNodeParser.from_defaults(
-            window_size=5,
-            window_metadata_key="window",
-            original_text_metadata_key="original_text",
-        )
+        # 创建集合，新建的集合中没有任何对象，清单中的记录全部作废
+        if not client.collections.exists(index_name):
+            manifest = {"parser": None, "files": {}}
+            client.collections.create(
+                name=index_name,
+                # file_path 和构建 id 整体作为一个词元，过滤时精确匹配
+                properties=[
+                    Property(name="file_path", data_type=DataType.TEXT, tokenization=Tokenization.FIELD),
+                    Property(name=build_id_key, data_type=DataType.TEXT, tokenization=Tokenization.FIELD),
+                ],
+                vector_index_config=Configure.VectorIndex.hnsw(
+                    quantizer=Configure.VectorIndex.Quantizer.sq(training_limit=sq_training_limit)
+                ),
+            )
+            print("documents collection has been created.")
+        collection = client.collections.get(index_name)
 
-        # 获取所有节点和叶子节点
-        nodes = node_parser.get_nodes_from_documents(documents)
+        # 按文件内容摘要比对清单，只处理新增或修改过的文件
+        previous_hashes = manifest["files"]
+        changed_files = [f for f in input_files if previous_hashes.get(f) != file_hashes[f]]
+        removed_files = [f for f in previous_hashes if f not in file_hashes]
+        print(f"{len(changed_files)} files changed, {len(removed_files)} files removed.")
 
-        # 初始化 Weaviate 向量存储
-        vector_store = WeaviateVectorStore(
-            weaviate_client=client,
-            index_name=index_name,
-        )
+        for start in range(0, len(removed_files), 1000):
+            delete_objects_where(
+                collection,
+                Filter.by_property("file_path").contains_any(removed_files[start:start + 1000])
+            )
 
-        # 创建存储上下文
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        # load documents
+        documents = load_documents(changed_files) if changed_files else []
 
-        # 构建索引时传入数据
-        sentence_index = VectorStoreIndex(
-            nodes,
-            storage_context=storage_context,
-            show_progress=True
-        )
+        # 使用固定大小的批量写入代替逐条插入，多个批量请求并发发送，退出上下文时统一 flush
+        with client.batch.fixed_size(
+            batch_size=batch_size,
+            concurrent_requests=num_workers,
+            consistency_level=ConsistencyLevel(consistency_level) if consistency_level else None,
+        ) as batch, EmbeddingCache(embed_model_name, embed_cache_path) as cache:
+            asyncio.run(stream_nodes_to_weaviate(
+                documents,
+                node_parser,
+                index_name,
+                batch,
+                build_id,
+                cache=cache,
+                progress_callback=progress_callback,
+            ))
+
+        failed_objects = client.batch.failed_objects
+        if failed_objects:
+            # 不更新清单也不删除旧对象，下次构建时会重新处理这些文件
+            raise RuntimeError(f"{len(failed_objects)} objects failed to be written to Weaviate.")
+
+        # 新节点全部写入后，删除修改过的文件中属于旧构建的对象
+        stale_count = 0
+        for start in range(0, len(changed_files), 1000):
+            stale_count += delete_objects_where(
+                collection,
+                Filter.by_property("file_path").contains_any(changed_files[start:start + 1000])
+                & Filter.by_property(build_id_key).not_equal(build_id)
+            )
+        print(f"{stale_count} stale objects deleted.")
 
+        save_manifest(index_name, {"parser": parser_signature, "files": file_hashes})
         print("All vector data has been written to Weaviate.")
 
     except Exception as e:
@@ -159,6 +327,26 @@ def build_sentence_window_index(input_files, index_name):
             client.close()  # Ensure client is always closed
             print("Weaviate connection closed.")
 
+def build_basic_fixed_size_index(input_files, index_name, chunk_size=1024, chunk_overlap=200, **kwargs):
+    # 设置文档分割器
+    splitter = get_sentence_splitter(chunk_size, chunk_overlap)
+    create_document_index(input_files, index_name, splitter, **kwargs)
+
+# for auto-merging retriever
+def build_automerging_index(input_files, index_name, chunk_sizes=None, **kwargs):
+    chunk_sizes = chunk_sizes or [2048, 512, 128]
+    node_parser = get_hierarchical_node_parser(tuple(chunk_sizes))
+
+    # 所有层级的节点（包括父节点）都写入 Weaviate
+    create_document_index(input_files, index_name, node_parser, **kwargs)
+
+
+# the sentence window retrieval
+def build_sentence_window_index(input_files, index_name, **kwargs):
+    # create the sentence window node parser w/ default settings
+    node_parser = get_sentence_window_node_parser(window_size=5)
+    create_document_index(input_files, index_name, node_parser, **kwargs)
+
 def delete_document_collections(index_names):
     """批量删除 Weaviate 中的集合
     Args:
@@ -179,6 +367,7 @@ def delete_document_collections(index_names):
                 print(f"Collection '{index_name}' has been deleted.")
             else:
                 print(f"Collection '{index_name}' does not exist.")
+            delete_manifest(index_name)
                 
     except Exception as e:
         print(f"Error occurred while deleting collections: {str(e)}")
@@ -0,0 +1,64 @@
+from functools import lru_cache
+from llama_index.core.embeddings import resolve_embed_model
+from llama_index.core.node_parser import SentenceSplitter, HierarchicalNodeParser, SentenceWindowNodeParser
+from src.reranker import ONNXRerank
+from src.embedding_lru import enable_embedding_lru
+
+embed_model_name = "local:/Users/Daglas/dalong.modelsets/bge-m3"
+embed_batch_size = 64
+# 词向量 LRU 保留的行数占词表的比例，设为 None 则保留完整的词向量表
+embed_table_cache_ratio = 0.1
+
+
+@lru_cache(maxsize=1)
+def get_embed_model():
+    # resolve_embed_model 不接受 batch 参数，加载后再设置每批送入 bge-m3 的文本数
+    embed_model = resolve_embed_model(embed_model_name)
+    embed_model.embed_batch_size = embed_batch_size
+    if embed_table_cache_ratio:
+        enable_embedding_lru(embed_model, cache_ratio=embed_table_cache_ratio)
+    return embed_model
+
+
+@lru_cache(maxsize=None)
+def get_reranker(top_n=2):
+    # ONNX 会话本身是按模型目录缓存的单例，不同 top_n 的实例共享同一个会话
+    return ONNXRerank(top_n=top_n)
+
+
+@lru_cache(maxsize=None)
+def get_sentence_splitter(chunk_size=1024, chunk_overlap=200):
+    return SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+@lru_cache(maxsize=None)
+def get_hierarchical_node_parser(chunk_sizes=(2048, 512, 128)):
+    return HierarchicalNodeParser.from_defaults(chunk_sizes=list(chunk_sizes))
+
+
+@lru_cache(maxsize=None)
+def get_sentence_window_node_parser(window_size=5):
+    return SentenceWindowNodeParser.from_defaults(
+        window_size=window_size,
+        window_metadata_key="window",
+        original_text_metadata_key="original_text",
+    )
+
+
+def warm_up_models(include_reranker=False):
+    """预先加载模型并各跑一次推理，避免第一个请求承担初始化耗时
+    Args:
+        include_reranker: 是否同时加载重排模型；首次加载会导出 ONNX 量化模型，耗时数分钟，
+            API 的 /query 不做重排，默认不加载
+    """
+    get_embed_model().get_query_embedding("warm up")
+    if include_reranker:
+        get_reranker()._predict([("warm up", "warm up")])
+    get_sentence_splitter()
+    get_hierarchical_node_parser()
+    get_sentence_window_node_parser()
+
+
+if __name__ == "__main__":
+    # 一次性完成词向量表和 ONNX 重排模型的导出，之后 API 的各个 worker 直接读取导出结果
+    warm_up_models(include_reranker=True)
@@ -0,0 +1,265 @@
+import os, shutil, hashlib, threading, platform
+import numpy as np
+from collections import OrderedDict
+from typing import Any, List, Optional
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.callbacks import CBEventType, EventPayload
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.utils import infer_torch_device
+from src.topk import topk_nodes
+
+reranker_model_name = "/Users/Daglas/dalong.modelsets/bge-reranker-v2-m3"
+reranker_max_length = 512
+
+
+class ScoreCache:
+    """线程安全的 LRU 打分缓存，键为 (模型, blake2b(query) + blake2b(chunk))"""
+
+    def __init__(self, max_items=100_000):
+        self.max_items = max_items
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, query, text):
+        query_hash = hashlib.blake2b(query.encode("utf-8"), digest_size=16).digest()
+        text_hash = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        return (model, query_hash + text_hash)
+
+    def get(self, key):
+        with self._lock:
+            score = self._data.get(key)
+            if score is not None:
+                self._data.move_to_end(key)
+            return score
+
+    def set(self, key, score):
+        with self._lock:
+            self._data[key] = score
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+
+# 所有重排器实例共享同一个打分缓存
+score_cache = ScoreCache()
+
+
+class CachedRerank(BaseNodePostprocessor):
+    """带打分缓存的 cross-encoder 重排器
+
+    bge-reranker-v2-m3 是双向注意力的 encoder，文档 token 的表示依赖于 query，
+    无法像 decoder 重排器那样无损复用文档侧的 KV cache；这里缓存整个 (query, chunk) 的打分，
+    同一问题重复检索到的 chunk 不再重新过模型。
+    """
+
+    model: str = Field(description="Cross-encoder model name or path.")
+    top_n: int = Field(description="Number of nodes to return sorted by score.")
+    device: str = Field(default="cpu", description="Device to run the model on.")
+    keep_retrieval_score: bool = Field(
+        default=False,
+        description="Whether to keep the retrieval score in metadata.",
+    )
+    _model: Any = PrivateAttr()
+
+    def __init__(
+        self,
+        top_n: int = 2,
+        model: str = reranker_model_name,
+        device: Optional[str] = None,
+        keep_retrieval_score: bool = False,
+    ):
+        super().__init__(
+            top_n=top_n,
+            model=model,
+            device=infer_torch_device() if device is None else device,
+            keep_retrieval_score=keep_retrieval_score,
+        )
+        self._model = self._load_model()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedRerank"
+
+    def _load_model(self):
+        from sentence_transformers import CrossEncoder
+
+        return CrossEncoder(self.model, max_length=reranker_max_length, device=self.device)
+
+    def _predict(self, pairs):
+        # 按文本长度排序后交给 CrossEncoder 分批推理，减少批内 padding，再按原顺序还原分数
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+        sorted_scores = self._model.predict([pairs[i] for i in order], batch_size=16)
+        scores = [0.0] * len(pairs)
+        for i, score in zip(order, sorted_scores):
+            scores[i] = float(score)
+        return scores
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if len(nodes) == 0:
+            return []
+
+        query_str = query_bundle.query_str
+        texts = [node.node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        cache_id = f"{self.class_name()}:{self.model}"
+        keys = [score_cache.make_key(cache_id, query_str, text) for text in texts]
+        scores = [score_cache.get(key) for key in keys]
+
+        with self.callback_manager.event(
+            CBEventType.RERANKING,
+            payload={
+                EventPayload.NODES: nodes,
+                EventPayload.MODEL_NAME: self.model,
+                EventPayload.QUERY_STR: query_str,
+                EventPayload.TOP_K: self.top_n,
+            },
+        ) as event:
+            # 只对未命中缓存的 (query, chunk) 调用模型
+            misses = [i for i, score in enumerate(scores) if score is None]
+            if misses:
+                predicted = self._predict([(query_str, texts[i]) for i in misses])
+                for i, score in zip(misses, predicted):
+                    scores[i] = float(score)
+                    score_cache.set(keys[i], scores[i])
+
+            for node, score in zip(nodes, scores):
+                if self.keep_retrieval_score:
+                    # keep the retrieval score in metadata
+                    node.node.metadata["retrieval_score"] = node.score
+                node.score = score
+
+            new_nodes = topk_nodes(nodes, self.top_n)
+            event.on_end(payload={EventPayload.NODES: new_nodes})
+
+        return new_nodes
+
+
+onnx_model_file = "model_quantized.onnx"
+
+# ONNX Runtime 会话初始化耗时较长，按模型目录缓存为进程内单例
+_onnx_sessions = {}
+_onnx_sessions_lock = threading.Lock()
+
+
+def export_quantized_reranker(model, onnx_dir):
+    """将 HuggingFace 重排模型导出为 ONNX 并做 INT8 动态量化
+    先导出到本进程的临时目录，完成后整体改名为 onnx_dir，多个进程同时导出时不会写坏同一目录
+    Args:
+        model: 原始模型名称或路径
+        onnx_dir: 量化后模型的保存目录
+    """
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    ort_model = ORTModelForSequenceClassification.from_pretrained(model, export=True)
+    # Apple Silicon 等 ARM 机器没有 VNNI 指令，使用 arm64 的量化配置
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        qconfig = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+    else:
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    tmp_dir = f"{onnx_dir.rstrip('/')}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    quantizer = ORTQuantizer.from_pretrained(ort_model)
+    quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+    AutoTokenizer.from_pretrained(model).save_pretrained(tmp_dir)
+
+    onnx_path = os.path.join(onnx_dir, onnx_model_file)
+    # 旧版本中断的导出可能留下不完整的目录
+    if os.path.isdir(onnx_dir) and not os.path.exists(onnx_path):
+        shutil.rmtree(onnx_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, onnx_dir)
+    except OSError:
+        # 其他进程已先完成导出，丢弃本进程的结果
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(onnx_path):
+            raise
+
+
+def get_onnx_session(model, onnx_dir):
+    """获取 (InferenceSession, tokenizer) 单例，首次调用时按需导出量化模型"""
+    with _onnx_sessions_lock:
+        if onnx_dir not in _onnx_sessions:
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+
+            onnx_path = os.path.join(onnx_dir, onnx_model_file)
+            if not os.path.exists(onnx_path):
+                export_quantized_reranker(model, onnx_dir)
+
+            providers = ["CPUExecutionProvider"]
+            if "CUDAExecutionProvider" in ort.get_available_providers():
+                providers.insert(0, "CUDAExecutionProvider")
+            session = ort.InferenceSession(onnx_path, providers=providers)
+            tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+            _onnx_sessions[onnx_dir] = (session, tokenizer)
+        return _onnx_sessions[onnx_dir]
+
+
+class ONNXRerank(CachedRerank):
+    """使用 INT8 量化 ONNX 模型打分的重排器，CPU 上比 FP32 的 CrossEncoder 快数倍"""
+
+    onnx_dir: str = Field(description="Directory of the quantized ONNX model.")
+    batch_size: int = Field(default=16, description="Number of pairs per inference batch.")
+
+    def __init__(
+        self,
+        top_n: int = 2,
+        model: str = reranker_model_name,
+        onnx_dir: Optional[str] = None,
+        batch_size: int = 16,
+        keep_retrieval_score: bool = False,
+    ):
+        BaseNodePostprocessor.__init__(
+            self,
+            top_n=top_n,
+            model=model,
+            device="cpu",
+            keep_retrieval_score=keep_retrieval_score,
+            onnx_dir=onnx_dir or f"{model.rstrip('/')}-onnx-int8",
+            batch_size=batch_size,
+        )
+        self._model = self._load_model()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ONNXRerank"
+
+    def _load_model(self):
+        return get_onnx_session(self.model, self.onnx_dir)
+
+    def _predict(self, pairs):
+        session, tokenizer = self._model
+        input_names = {i.name for i in session.get_inputs()}
+
+        # 先整体分词，按 token 长度排序后分桶，每个桶只 padding 到桶内最长的序列
+        features = tokenizer(
+            [query for query, _ in pairs],
+            [text for _, text in pairs],
+            truncation=True,
+            max_length=reranker_max_length,
+        )
+        lengths = [len(ids) for ids in features["input_ids"]]
+        order = sorted(range(len(pairs)), key=lengths.__getitem__)
+
+        scores = [0.0] * len(pairs)
+        for start in range(0, len(order), self.batch_size):
+            bucket = order[start:start + self.batch_size]
+            batch = tokenizer.pad(
+                {k: [v[i] for i in bucket] for k, v in features.items()},
+                return_tensors="np",
+            )
+            inputs = {k: v for k, v in batch.items() if k in input_names}
+            logits = session.run(None, inputs)[0]
+            # 与 CrossEncoder 单标签输出一致，使用 sigmoid 将 logit 映射为分数
+            for i, logit in zip(bucket, logits[:, 0]):
+                scores[i] = float(1 / (1 + np.exp(-logit)))
+        return scores
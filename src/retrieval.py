@@ -3,10 +3,13 @@ from llama_index.core import Settings
 from llama_index.core import VectorStoreIndex
 from llama_index.core.query_engine import RetrieverQueryEngine
 from llama_index.core.retrievers import AutoMergingRetriever, BaseRetriever
-from llama_index.core.indices.postprocessor import SentenceTransformerRerank, MetadataReplacementPostProcessor
+from llama_index.core.indices.postprocessor import MetadataReplacementPostProcessor
 from llama_index.vector_stores.weaviate import WeaviateVectorStore
+from src.models import get_embed_model, get_reranker
+from src.topk import topk_nodes
+from src.utils import is_literal_query
 
-reranker_model_name = "/Users/Daglas/dalong.modelsets/bge-reranker-v2-m3"
+Settings.embed_model = get_embed_model()
 
 def get_all_index_names():
     try:
@@ -60,12 +63,9 @@ def basic_query_from_documents(question, index_names, similarity_top_k):
                     retrieved_nodes = retriever.retrieve(query, **kwargs)
                     all_nodes.extend(retrieved_nodes)
                 
-                # 按相似度分数降序排序（分数越高越相关）
-                sorted_nodes = sorted(all_nodes, key=lambda x: x.score, reverse=True)
-                
-                # 截取前 similarity_top_k 个节点
-                return sorted_nodes[:self.similarity_top_k]
-                # top_k_nodes = sorted_nodes[:self.similarity_top_k]
+                # 按相似度分数选出前 similarity_top_k 个节点（分数越高越相关）
+                return topk_nodes(all_nodes, self.similarity_top_k)
+                # top_k_nodes = topk_nodes(all_nodes, self.similarity_top_k)
                 
                 # # 剔除score值低于0.4的节点
                 # filtered_nodes = [node for node in top_k_nodes if node.score >= 0.4]
@@ -134,18 +134,18 @@ def sentence_window_query_from_documents(
         sentence_index = VectorStoreIndex.from_vector_store(vector_store)
 
         # define postprocessors
+        literal_query = is_literal_query(question)
         postproc = MetadataReplacementPostProcessor(target_metadata_key="window")
-        rerank = SentenceTransformerRerank(
-            top_n=rerank_top_n, model=reranker_model_name
-        )
+        node_postprocessors = [postproc] if literal_query else [postproc, get_reranker(top_n=rerank_top_n)]
 
         sentence_window_engine = sentence_index.as_query_engine(
-            similarity_top_k=similarity_top_k, node_postprocessors=[postproc, rerank]
+            similarity_top_k=similarity_top_k, node_postprocessors=node_postprocessors
         )
 
         response = sentence_window_engine.query(question)
 
-        return response.source_nodes
+        # 精确查询跳过重排，直接按向量分数取前 rerank_top_n 个节点
+        return topk_nodes(response.source_nodes, rerank_top_n) if literal_query else response.source_nodes
 
     except Exception as e:
         print(f"Error occurred: {str(e)}")
@@ -181,18 +181,18 @@ def automerging_query_from_documents(
             verbose=True
         )
 
-        rerank = SentenceTransformerRerank(
-            top_n=rerank_top_n, model=reranker_model_name
-        )
+        literal_query = is_literal_query(question)
+        node_postprocessors = [] if literal_query else [get_reranker(top_n=rerank_top_n)]
 
         auto_merging_engine = RetrieverQueryEngine.from_args(
             retriever, 
-            node_postprocessors=[rerank]
+            node_postprocessors=node_postprocessors
         )
 
         response = auto_merging_engine.query(question)
 
-        return response.source_nodes
+        # 精确查询跳过重排，直接按向量分数取前 rerank_top_n 个节点
+        return topk_nodes(response.source_nodes, rerank_top_n) if literal_query else response.source_nodes
 
     except Exception as e:
         print(f"Error occurred: {str(e)}")
@@ -0,0 +1,70 @@
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True, fastmath=True)
+def topk(scores, k):
+    """用大小为 k 的最小堆选出分数最高的 k 个元素
+    Args:
+        scores: 一维 float32 连续数组
+        k: 需要返回的元素个数
+    Returns:
+        tuple: (按分数降序排列的分数数组, 对应的下标数组)
+    """
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        # 空堆上访问 heap_scores[0] 会越界，njit 不做边界检查
+        return np.empty(0, dtype=scores.dtype), np.empty(0, dtype=np.int64)
+    heap_scores = np.empty(k, dtype=scores.dtype)
+    heap_indices = np.empty(k, dtype=np.int64)
+    size = 0
+
+    for i in range(scores.shape[0]):
+        score = scores[i]
+        if size < k:
+            # 堆未满，插入末尾后上浮
+            pos = size
+            size += 1
+            while pos > 0:
+                parent = (pos - 1) // 2
+                if heap_scores[parent] <= score:
+                    break
+                heap_scores[pos] = heap_scores[parent]
+                heap_indices[pos] = heap_indices[parent]
+                pos = parent
+            heap_scores[pos] = score
+            heap_indices[pos] = i
+        elif score > heap_scores[0]:
+            # 替换堆顶后下沉
+            pos = 0
+            while True:
+                child = 2 * pos + 1
+                if child >= size:
+                    break
+                if child + 1 < size and heap_scores[child + 1] < heap_scores[child]:
+                    child += 1
+                if heap_scores[child] >= score:
+                    break
+                heap_scores[pos] = heap_scores[child]
+                heap_indices[pos] = heap_indices[child]
+                pos = child
+            heap_scores[pos] = score
+            heap_indices[pos] = i
+
+    order = np.argsort(-heap_scores)
+    return heap_scores[order], heap_indices[order]
+
+
+def topk_nodes(nodes, k):
+    """按 node.score 选出分数最高的 k 个 NodeWithScore，score 为 None 的节点排在最后，k <= 0 时返回空列表"""
+    if not nodes or k <= 0:
+        return []
+    scores = np.ascontiguousarray(
+        [np.finfo(np.float32).min if n.score is None else n.score for n in nodes], dtype=np.float32
+    )
+    _, indices = topk(scores, k)
+    return [nodes[i] for i in indices]
+
+
+# 导入时完成 JIT 编译，避免第一个请求承担编译耗时
+topk(np.zeros(1, dtype=np.float32), 1)
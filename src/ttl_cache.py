@@ -0,0 +1,38 @@
+import time, threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """带过期时间的 LRU 缓存
+
+    超过 ttl_sec 的条目在读取时失效，条目数超过 max_items 时淘汰最久未使用的条目。
+    """
+
+    def __init__(self, max_items=2048, ttl_sec=30):
+        self.max_items = max_items
+        self.ttl_sec = ttl_sec
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_sec, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -1,6 +1,8 @@
-import os, time
+import os, io, re, time
 import string
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from blake3 import blake3
 
 
 def get_chat_file_name(input_str: str) -> str:
@@ -40,6 +42,20 @@ def get_chat_file_name(input_str: str) -> str:
     return final_str
 
 
+# 文件名、标签或整句加引号的精确查询，向量检索已能直接命中，不需要再重排
+literal_query_patterns = [
+    re.compile(r'^"[^"]+"$'),
+    re.compile(r'^“[^”]+”$'),
+    re.compile(r'^[\w\-.]+\.(md|pdf|txt)$'),
+    re.compile(r'^#\w+$'),
+]
+
+
+def is_literal_query(question):
+    question = question.strip()
+    return any(pattern.match(question) for pattern in literal_query_patterns)
+
+
 def get_timestamp():
     timestamp = time.strftime("%Y%m%d%H%M%S", time.localtime())
     return timestamp
@@ -59,10 +75,52 @@ def get_all_files_from_directory(directory_path, file_extension=None):
     if not path.exists() or not path.is_dir():
         raise ValueError(f"Invalid directory path: {directory_path}")
     
-    if file_extension:
-        return [str(file) for file in path.rglob(f"*.{file_extension}") if file.is_file()]
-    else:
-        return [str(file) for file in path.rglob("*") if file.is_file()]
+    pattern = f"*.{file_extension}" if file_extension else "*"
+    return filter_existing_files([str(file) for file in path.rglob(pattern)])
+
+def filter_existing_files(file_paths, max_workers=16):
+    """并发检查文件是否存在，过滤掉不存在的路径和目录
+
+    Args:
+        file_paths (list): 文件路径列表
+        max_workers (int, optional): 线程数。默认为16
+
+    Returns:
+        list: 存在的文件路径列表，保持原有顺序
+    """
+    missing_files = set(find_missing_files(file_paths, max_workers=max_workers))
+    return [file_path for file_path in file_paths if file_path not in missing_files]
+
+def find_missing_files(file_paths, max_workers=16):
+    """并发检查文件是否存在，返回不存在或不是文件的路径
+
+    Args:
+        file_paths (list): 文件路径列表
+        max_workers (int, optional): 线程数。默认为16
+
+    Returns:
+        list: 不存在的文件路径列表，保持原有顺序
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        is_file = list(executor.map(os.path.isfile, file_paths))
+    return [file_path for file_path, exists in zip(file_paths, is_file) if not exists]
+
+def hash_files(file_paths, max_workers=16):
+    """并发计算文件内容的 blake3 摘要
+
+    Args:
+        file_paths (list): 文件路径列表
+        max_workers (int, optional): 线程数。默认为16
+
+    Returns:
+        dict: 文件路径 -> 十六进制摘要
+    """
+    def hash_file(file_path):
+        return blake3().update_mmap(file_path).hexdigest()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        digests = list(executor.map(hash_file, file_paths))
+    return dict(zip(file_paths, digests))
 
 def print_data_sources(source_datas):
     full_content = ""
@@ -73,6 +131,28 @@ def print_data_sources(source_datas):
     return full_content
 
 
+def collect_context_and_sources(source_datas):
+    """一次遍历检索结果，同时拼接 LLM 上下文和数据来源记录，并打印数据来源
+    Args:
+        source_datas: 检索返回的 NodeWithScore 列表
+    Returns:
+        tuple: (上下文文本, 数据来源记录文本, 上下文的 UTF-8 字节数)
+    """
+    context_buf = io.StringIO()
+    sources_buf = io.StringIO()
+    len_bytes = 0
+    print("\n\nsource_datas----------------------------------------------------------------source_datas")
+    for n in source_datas:
+        text = n.text
+        context_buf.write(text)
+        context_buf.write("\n")
+        len_bytes += len(text.encode("utf-8")) + 1
+        source = f"{n.score}\n\n{n.metadata}\n\n{text}\n----------------------------------------------------------------------------------------\n"
+        sources_buf.write(f"score: {source}")
+        print(source)
+    return context_buf.getvalue(), sources_buf.getvalue(), len_bytes
+
+
 if __name__ == "__main__":
     result = get_timestamp()
     print(result)
\ No newline at end of file
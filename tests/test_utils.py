@@ -0,0 +1,20 @@
+from src.utils import is_literal_query
+
+
+def test_is_literal_query_matches_quoted_phrases():
+    assert is_literal_query('"scaled dot-product attention"')
+    assert is_literal_query('“唐朝四大诗人”')
+    assert is_literal_query('  "padded with whitespace"  ')
+
+
+def test_is_literal_query_matches_file_names_and_tags():
+    assert is_literal_query("2025021Genius_Unmasked.md")
+    assert is_literal_query("report-v2.pdf")
+    assert is_literal_query("#读书笔记")
+
+
+def test_is_literal_query_rejects_natural_language_questions():
+    assert not is_literal_query("中国唐朝最著名的四位诗人")
+    assert not is_literal_query('What does "attention" mean here?')
+    assert not is_literal_query("notes.docx")
+    assert not is_literal_query("")